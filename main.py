@@ -1,17 +1,21 @@
 import os
-import json
+import re
+import asyncio
+import orjson
 import joblib
-import pandas as pd
 import numpy as np
+from collections import Counter
+from contextlib import asynccontextmanager
+from itertools import chain
 from datetime import datetime, timedelta, timezone
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 
 from fastapi import FastAPI, HTTPException, Query, Body
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
-from xgboost import XGBClassifier, XGBRegressor
-import shap
+from xgboost import XGBClassifier, XGBRegressor, DMatrix
 from dotenv import load_dotenv
 
 # ─────────────────────────── ENV ───────────────────────────
@@ -26,20 +30,64 @@ CLASSIFIER_PATH = os.path.join(ARTIFACT_DIR, "xgb_sleep_disorder.pth")
 PREPROCESSOR_PATH = os.path.join(ARTIFACT_DIR, "preprocessor.pkl")
 COHERE_API_KEY = os.getenv("COHERE_API_KEY", "") 
 
+# ───────────────────── Shared HTTP pool ────────────────────
+# Keep-alive pooling: Supabase and Cohere calls reuse warm connections
+# instead of paying a TLS handshake each time. HTTP/2 multiplexes
+# concurrent requests over one socket.
+import httpx
+HTTP_LIMITS = httpx.Limits(
+    max_keepalive_connections=100, max_connections=200, keepalive_expiry=30.0
+)
+shared_http: Optional[httpx.AsyncClient] = None
+
 # ────────────────────── Supabase client ────────────────────
-from supabase import create_client, Client
-supabase: Optional[Client] = None
-if SUPABASE_URL and SUPABASE_ANON_KEY:
-    supabase = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
+# Async client so Supabase round-trips interleave on the event loop
+# instead of occupying FastAPI threadpool slots; created on startup.
+from supabase import create_async_client, AsyncClient, AsyncClientOptions
+supabase: Optional[AsyncClient] = None
 
 # ─────────────────────── Cohere client ─────────────────────
 import cohere
 co = None
 if COHERE_API_KEY:
-    co = cohere.Client(COHERE_API_KEY)
+    co = cohere.AsyncClient(
+        COHERE_API_KEY, httpx_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+    )
 
 # ───────────────────────── FastAPI ─────────────────────────
-app = FastAPI(title="SleepWise Coach API", version="1.3.0")
+@asynccontextmanager
+async def lifespan(app: "FastAPI"):
+    global batch_queue, log_queue, supabase, shared_http
+    load_artifacts()  # warm the lazy singletons before traffic arrives
+    # bounded so a stalled worker applies backpressure instead of
+    # buffering unbounded rows
+    batch_queue = asyncio.Queue(maxsize=MAX_BATCH * 4)
+    batch_task = asyncio.create_task(batcher())
+    log_queue = asyncio.Queue()
+    log_task = asyncio.create_task(log_flusher())
+    if SUPABASE_URL and SUPABASE_ANON_KEY:
+        shared_http = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+        supabase = await create_async_client(
+            SUPABASE_URL, SUPABASE_ANON_KEY,
+            options=AsyncClientOptions(httpx_client=shared_http)
+        )
+    yield
+    batch_task.cancel()
+    log_task.cancel()
+    # push out anything still buffered before the pool closes
+    leftovers = []
+    while not log_queue.empty():
+        leftovers.append(log_queue.get_nowait())
+    await flush_log_rows(leftovers)
+    if shared_http:
+        await shared_http.aclose()
+
+app = FastAPI(
+    title="SleepWise Coach API",
+    version="1.3.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 origins = [
     "https://mysleepwise.netlify.app",
@@ -55,15 +103,174 @@ app.add_middleware(
 )
 
 # ─────────────────── Load models & artifacts ───────────────
-regressor: XGBRegressor = joblib.load(REGRESSOR_PATH)
-classifier: XGBClassifier = joblib.load(CLASSIFIER_PATH)
-preproc = joblib.load(PREPROCESSOR_PATH)
-feature_columns: List[str] = preproc["feature_columns"]
-num_medians: Dict[str, float] = preproc["num_medians"]
-cat_modes: Dict[str, str] = preproc["cat_modes"]
-cat_cols: List[str] = preproc["cat_cols"]
-bp_cols: List[str] = preproc["bp_cols"]
-shap_explainer = shap.TreeExplainer(classifier)
+# Loaded lazily via load_artifacts() so importing main.py stays cheap:
+# workers come up fast and fork-based deployments can share the pages.
+# The lifespan hook warms everything before the first request.
+regressor: Optional[XGBRegressor] = None
+classifier: Optional[XGBClassifier] = None
+reg_booster = None
+cls_booster = None
+tl_reg = None
+tl_cls = None
+fil_reg = None
+fil_cls = None
+# below this batch size GPU dispatch overhead outweighs the parallelism
+FIL_MIN_BATCH = 16
+
+feature_columns: List[str] = []
+FEATURE_NAMES: Tuple[str, ...] = ()
+num_medians: Dict[str, float] = {}
+cat_modes: Dict[str, str] = {}
+cat_cols: List[str] = []
+bp_cols: List[str] = []
+
+COL_IDX: Dict[str, int] = {}
+ONEHOT_IDX: Dict[str, Dict[str, int]] = {}
+ONEHOT_SLOTS: Dict[str, np.ndarray] = {}
+DEFAULT_ROW: Optional[np.ndarray] = None
+NUM_FIELD_IDX: List[Tuple[str, int]] = []
+NUM_IDX_ARR: Optional[np.ndarray] = None
+CAT_FIELDS = [("bmi_category", "BMI Category"), ("gender", "Gender")]
+BP_SYS_IDX: Optional[int] = None
+BP_DIA_IDX: Optional[int] = None
+
+# Optional Numba JIT for the per-request numeric fill. The loop is tiny
+# but sits on every /predict; compiled it collapses to a handful of
+# scalar stores with no interpreter or NumPy dispatch in between. When
+# numba is absent the same function runs interpreted, so behaviour is
+# identical either way.
+try:
+    from numba import njit
+except ImportError:  # pragma: no cover - numba is a pinned dependency
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+@njit(cache=True)
+def _fill_numeric(row, vals, idxs):
+    # NaN marks "not provided": the median baked into the row stays put
+    for k in range(vals.shape[0]):
+        if not np.isnan(vals[k]):
+            row[idxs[k]] = vals[k]
+
+def load_artifacts() -> None:
+    """Load models and build the preprocessing tables. Idempotent."""
+    global regressor, classifier, reg_booster, cls_booster, tl_reg, tl_cls, fil_reg, fil_cls
+    global feature_columns, FEATURE_NAMES, num_medians, cat_modes, cat_cols, bp_cols
+    global COL_IDX, ONEHOT_IDX, ONEHOT_SLOTS, DEFAULT_ROW, NUM_FIELD_IDX, NUM_IDX_ARR, BP_SYS_IDX, BP_DIA_IDX
+    if regressor is not None:
+        return
+
+    regressor = joblib.load(REGRESSOR_PATH, mmap_mode="r")
+    classifier = joblib.load(CLASSIFIER_PATH, mmap_mode="r")
+    preproc = joblib.load(PREPROCESSOR_PATH)
+    feature_columns = preproc["feature_columns"]
+    FEATURE_NAMES = tuple(feature_columns)
+    num_medians = preproc["num_medians"]
+    cat_modes = preproc["cat_modes"]
+    cat_cols = preproc["cat_cols"]
+    bp_cols = preproc["bp_cols"]
+
+    # Raw boosters: inplace_predict on a float32 array skips the DMatrix
+    # construction that dominates small-batch predict cost.
+    reg_booster = regressor.get_booster()
+    cls_booster = classifier.get_booster()
+
+    # Single-threaded predict: XGBoost otherwise grabs every core per
+    # call, which thrashes when several Uvicorn workers predict at once.
+    # Concurrency comes from process fan-out; the batch worker raises the
+    # thread count only for large batches.
+    reg_booster.set_param({"nthread": 1})
+    cls_booster.set_param({"nthread": 1})
+
+    # Opt-in CUDA: pred_contribs (TreeSHAP) and inplace_predict both
+    # dispatch to the GPU predictor once the boosters live on device.
+    if os.getenv("XGB_DEVICE", "").lower() == "cuda":
+        reg_booster.set_param({"device": "cuda"})
+        cls_booster.set_param({"device": "cuda"})
+        print("✅ XGBoost boosters moved to CUDA")
+
+    # Optional Treelite-compiled predictors (model/compile_treelite.py
+    # emits the .so files). Compiled tree code beats inplace_predict on
+    # small batches; fall back to the boosters when they're absent.
+    try:
+        global tl2cgen
+        import tl2cgen
+        reg_lib = os.path.join(ARTIFACT_DIR, "xgb_sleep_quality.so")
+        cls_lib = os.path.join(ARTIFACT_DIR, "xgb_sleep_disorder.so")
+        if os.path.exists(reg_lib) and os.path.exists(cls_lib):
+            tl_reg = tl2cgen.Predictor(reg_lib)
+            tl_cls = tl2cgen.Predictor(cls_lib)
+            print("✅ Treelite predictors loaded")
+    except Exception as e:
+        print(f"ℹ️ Treelite predictors unavailable, using XGBoost boosters: {e}")
+
+    # Optional RAPIDS FIL (GPU) for large drained batches. Only loads on
+    # CUDA hosts with cuml installed; everything else keeps the CPU path.
+    try:
+        from cuml import ForestInference
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            reg_json = os.path.join(tmp, "reg.json")
+            cls_json = os.path.join(tmp, "cls.json")
+            reg_booster.save_model(reg_json)
+            cls_booster.save_model(cls_json)
+            fil_reg = ForestInference.load(reg_json, model_type="xgboost_json")
+            fil_cls = ForestInference.load(cls_json, model_type="xgboost_json",
+                                           output_class=True)
+        print("✅ FIL GPU predictors loaded")
+    except Exception:
+        pass  # no GPU / no cuml — expected on most deployments
+
+    # Precomputed preprocessing tables: rebuilding a one-row DataFrame +
+    # get_dummies per request costs far more than the model inference, so
+    # the column layout is resolved once and preprocess_one just writes
+    # into a preallocated float32 row.
+    COL_IDX = {c: i for i, c in enumerate(feature_columns)}
+
+    # One-hot slots per categorical: {"BMI Category": {"Obese": idx, ...}}
+    ONEHOT_IDX = {
+        cat: {c[len(cat) + 1:]: i for c, i in COL_IDX.items() if c.startswith(cat + "_")}
+        for cat in cat_cols
+    }
+    # all dummy slots of a categorical, for one-shot fancy-index clears
+    ONEHOT_SLOTS = {
+        cat: np.fromiter(idxs.values(), dtype=np.intp) for cat, idxs in ONEHOT_IDX.items()
+    }
+
+    # Default row = numeric medians + the train-time mode's dummy slot (a
+    # mode that was the dropped-first level is encoded by the all-zero row).
+    DEFAULT_ROW = np.zeros(len(feature_columns), dtype=np.float32)
+    for col, median in num_medians.items():
+        if col in COL_IDX:
+            DEFAULT_ROW[COL_IDX[col]] = median
+    for cat in cat_cols:
+        mode_idx = ONEHOT_IDX[cat].get(cat_modes.get(cat, ""))
+        if mode_idx is not None:
+            DEFAULT_ROW[mode_idx] = 1.0
+
+    # payload attribute → numeric feature column
+    NUM_FIELD_IDX = [
+        (attr, COL_IDX[col]) for attr, col in [
+            ("sleep_duration", "Sleep Duration"),
+            ("physical_activity", "Physical Activity Level"),
+            ("stress_level", "Stress Level"),
+            ("heart_rate", "Heart Rate"),
+            ("daily_steps", "Daily Steps"),
+            ("age", "Age"),
+        ] if col in COL_IDX
+    ]
+    BP_SYS_IDX = COL_IDX.get("BP_Systolic")
+    BP_DIA_IDX = COL_IDX.get("BP_Diastolic")
+
+    # column index per slot of the numeric value vector, BP columns last
+    NUM_IDX_ARR = np.array(
+        [idx for _, idx in NUM_FIELD_IDX] + [BP_SYS_IDX, BP_DIA_IDX], dtype=np.intp
+    )
+    # warm the JIT so the first request doesn't pay compilation latency
+    _fill_numeric(DEFAULT_ROW.copy(),
+                  np.full(len(NUM_IDX_ARR), np.nan, dtype=np.float32), NUM_IDX_ARR)
 
 # ───────────────────────── Schemas ─────────────────────────
 class LogPayload(BaseModel):
@@ -89,86 +296,239 @@ class PredictResponse(BaseModel):
     rule_override_flag: bool
 
 # ───────────────────────── Helpers ─────────────────────────
-RISK_MAP = {0: "None", 1: "Insomnia", 2: "Sleep Apnea"}
+# tuple: O(1) index access, no hashing
+RISK_LABELS = ("None", "Insomnia", "Sleep Apnea")
+
+# age is bounded [0, 120] by the schema, so the bracket per age is a
+# table built once at import instead of a range scan per call
+_BRACKET_TABLE = [""] * 121
+for _lo, _hi in [(0,17),(18,24),(25,34),(35,44),(45,54),(55,64),(65,200)]:
+    for _a in range(_lo, min(_hi, 120) + 1):
+        _BRACKET_TABLE[_a] = f"{_lo}-{_hi}"
 
 def age_to_bracket(age: Optional[int]) -> str:
-    if age is None: return "Unknown"
-    for lo, hi in [(0,17),(18,24),(25,34),(35,44),(45,54),(55,64),(65,200)]:
-        if lo <= age <= hi: return f"{lo}-{hi}"
+    if age is not None and 0 <= age <= 120:
+        return _BRACKET_TABLE[age]
     return "Unknown"
 
-def get_user_id_from_token(token: Optional[str]) -> Optional[str]:
+# token → user_id cache: JWTs stay valid for minutes, so repeated requests
+# with the same token (dashboard polling) skip the Supabase auth round-trip.
+# Entries additionally respect the token's own exp claim, read without
+# signature verification — Supabase verified it on the initial lookup.
+from cachetools import TTLCache
+_token_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+import jwt
+
+def _token_exp(token: str) -> float:
+    try:
+        payload = jwt.decode(token, options={"verify_signature": False})
+        return float(payload.get("exp", float("inf")))
+    except Exception:
+        return float("inf")
+
+async def get_user_id_from_token(token: Optional[str]) -> Optional[str]:
     if not (token and supabase):
         return None
+    cached = _token_cache.get(token)
+    if cached is not None:
+        user_id, exp = cached
+        if datetime.now(timezone.utc).timestamp() < exp:
+            return user_id
+        _token_cache.pop(token, None)
     try:
-        res = supabase.auth.get_user(token)
-        return res.user.id if res and res.user else None
+        res = await supabase.auth.get_user(token)
+        user_id = res.user.id if res and res.user else None
     except Exception:
         return None
+    if user_id:
+        _token_cache[token] = (user_id, _token_exp(token))
+    return user_id
 
-def preprocess_one(payload: LogPayload) -> pd.DataFrame:
-    row = {
-        "Sleep Duration": payload.sleep_duration,
-        "Physical Activity Level": payload.physical_activity,
-        "Stress Level": payload.stress_level,
-        "BMI Category": payload.bmi_category,
-        "Blood Pressure": payload.blood_pressure,
-        "Heart Rate": payload.heart_rate,
-        "Daily Steps": payload.daily_steps,
-        "Age": payload.age,
-        "Gender": payload.gender
-    }
-    X = pd.DataFrame([row])
-
-    # BP split
-    if "Blood Pressure" in X.columns:
-        bp_split = X["Blood Pressure"].astype(str).str.split("/", expand=True)
-        X["BP_Systolic"] = pd.to_numeric(bp_split[0], errors="coerce")
-        X["BP_Diastolic"] = pd.to_numeric(bp_split[1], errors="coerce")
-        X.drop(columns=["Blood Pressure"], inplace=True)
-    else:
-        for c in bp_cols:
-            if c not in X.columns:
-                X[c] = np.nan
-
-    # Impute numerics
-    for col, median_val in num_medians.items():
-        if col in X.columns:
-            X[col] = pd.to_numeric(X[col], errors="coerce").fillna(median_val)
-        else:
-            X[col] = median_val
+def preprocess_one(payload: LogPayload) -> np.ndarray:
+    """Build a (1, n_features) float32 row by direct index writes.
+
+    Missing numerics keep the train-time medians baked into DEFAULT_ROW;
+    missing categoricals keep the mode's dummy slot. Unknown categorical
+    values leave all dummies zero, matching the old get_dummies+reindex.
+    """
+    x = DEFAULT_ROW.copy()
+
+    # Numeric fields gathered into one value vector (BP slots last) and
+    # written by the compiled fill in a single call.
+    vals = np.full(len(NUM_IDX_ARR), np.nan, dtype=np.float32)
+    for k, (attr, _idx) in enumerate(NUM_FIELD_IDX):
+        val = getattr(payload, attr)
+        if val is not None:
+            vals[k] = val
+
+    # BP split: "120/80" → systolic/diastolic; bad parses keep the medians
+    if payload.blood_pressure:
+        sys_part, _, dia_part = payload.blood_pressure.partition("/")
+        try:
+            vals[-2] = float(sys_part)
+            vals[-1] = float(dia_part)
+        except ValueError:
+            pass
+
+    _fill_numeric(x, vals, NUM_IDX_ARR)
 
-    # Impute categoricals
-    for c in cat_cols:
-        if c not in X.columns:
-            X[c] = cat_modes.get(c, "Unknown")
-        X[c] = X[c].fillna(cat_modes.get(c, "Unknown"))
+    for attr, cat in CAT_FIELDS:
+        val = getattr(payload, attr)
+        if val is not None:
+            x[ONEHOT_SLOTS[cat]] = 0.0
+            hit = ONEHOT_IDX[cat].get(val)
+            if hit is not None:
+                x[hit] = 1.0
 
-    # One-hot and align
-    X = pd.get_dummies(X, columns=cat_cols, drop_first=True)
-    for col in feature_columns:
-        if col not in X.columns:
-            X[col] = 0
-    return X[feature_columns]
+    return x.reshape(1, -1)
 
 def extract_top2_shap(sv_sample, feature_names) -> List[str]:
+    # O(n) top-2 selection instead of a full sort
     contrib = np.abs(sv_sample)
-    idxs = np.argsort(contrib)[::-1][:2]
+    idxs = np.argpartition(contrib, -2)[-2:]
+    idxs = idxs[np.argsort(contrib[idxs])[::-1]]
     return [feature_names[i] for i in idxs]
 
+async def store_coach_log(user_id: str, prompt: str, out: dict, source: str) -> None:
+    try:
+        await supabase.table("coach_logs").insert({
+            "user_id": str(user_id),
+            "prompt": prompt,
+            "response": orjson.dumps(out).decode(),
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }).execute()
+        print(f"✅ Coach log stored ({source})")
+    except Exception as e:
+        print(f"❌ Failed to log coach output ({source}): {e}")
+
 def rule_engine(disorder_risk: str, bmi_category: Optional[str]) -> Optional[str]:
     if disorder_risk == "Sleep Apnea" and (bmi_category or "").lower() == "obese":
         return "Recommend clinical evaluation; clinician review required."
     return None
 
+# ──────────────────── Micro-batched inference ──────────────
+# Requests enqueue their preprocessed row plus a Future; a single
+# background task drains the queue (up to MAX_BATCH rows or BATCH_WAIT_S),
+# runs XGBoost + SHAP once on the stacked matrix, and fans results back.
+# XGBoost releases the GIL inside predict, so the batch runs in a thread.
+MAX_BATCH = int(os.getenv("PREDICT_MAX_BATCH", 32))
+BATCH_WAIT_S = float(os.getenv("PREDICT_BATCH_WAIT_MS", 10)) / 1000.0
+
+batch_queue: Optional[asyncio.Queue] = None
+
+def run_inference_batch(X: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    # data parallelism only pays off once the batch is big enough
+    nthread = min(4, X.shape[0] // 8) if X.shape[0] >= 32 else 1
+    reg_booster.set_param({"nthread": nthread})
+    cls_booster.set_param({"nthread": nthread})
+    if fil_cls is not None and X.shape[0] >= FIL_MIN_BATCH:
+        qualities = np.asarray(fil_reg.predict(X)).reshape(X.shape[0])
+        class_idxs = np.asarray(fil_cls.predict(X)).reshape(X.shape[0]).astype(np.int64)
+    elif tl_reg is not None:
+        dmat = tl2cgen.DMatrix(X)
+        qualities = np.asarray(tl_reg.predict(dmat)).reshape(X.shape[0])
+        proba = np.asarray(tl_cls.predict(dmat)).reshape(X.shape[0], -1)
+        class_idxs = np.argmax(proba, axis=1)
+    else:
+        qualities = reg_booster.inplace_predict(X)
+        class_idxs = np.argmax(cls_booster.inplace_predict(X), axis=1)
+    # Native TreeSHAP: (n_rows, n_classes, n_features + 1), last column is
+    # the bias term. Same values as shap.TreeExplainer without the per-call
+    # Explanation object overhead.
+    contribs = cls_booster.predict(
+        DMatrix(X), pred_contribs=True, validate_features=False
+    )
+    return qualities, class_idxs, contribs
+
+async def batcher():
+    while True:
+        rows = [await batch_queue.get()]
+        deadline = asyncio.get_running_loop().time() + BATCH_WAIT_S
+        while len(rows) < MAX_BATCH:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(await asyncio.wait_for(batch_queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        frames, futures = zip(*rows)
+        X = np.vstack(frames)
+        try:
+            qualities, class_idxs, contribs = await asyncio.to_thread(run_inference_batch, X)
+            for i, fut in enumerate(futures):
+                if not fut.done():
+                    cls_idx = int(class_idxs[i])
+                    fut.set_result((float(qualities[i]), cls_idx, contribs[i, cls_idx, :-1]))
+        except Exception as e:
+            for fut in futures:
+                if not fut.done():
+                    fut.set_exception(e)
+
+async def infer_one(X: np.ndarray) -> Tuple[float, int, np.ndarray]:
+    fut = asyncio.get_running_loop().create_future()
+    await batch_queue.put((X, fut))
+    return await fut
+
+# ─────────────────── Buffered sleep_logs writes ────────────
+# /log only enqueues; a background task flushes up to LOG_FLUSH_MAX rows
+# (or whatever arrived within LOG_FLUSH_INTERVAL_S) in one insert, so the
+# endpoint never waits on Supabase and write QPS is amortized.
+LOG_FLUSH_MAX = int(os.getenv("LOG_FLUSH_MAX", 50))
+LOG_FLUSH_INTERVAL_S = float(os.getenv("LOG_FLUSH_INTERVAL_MS", 500)) / 1000.0
+
+log_queue: Optional[asyncio.Queue] = None
+
+async def flush_log_rows(rows: List[Dict[str, Any]]) -> None:
+    if not (rows and supabase):
+        return
+    try:
+        await supabase.table("sleep_logs").insert(rows).execute()
+    except Exception as e:
+        print(f"❌ Failed to flush {len(rows)} sleep_logs rows: {e}")
+
+async def log_flusher():
+    while True:
+        rows = [await log_queue.get()]
+        deadline = asyncio.get_running_loop().time() + LOG_FLUSH_INTERVAL_S
+        while len(rows) < LOG_FLUSH_MAX:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(await asyncio.wait_for(log_queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        await flush_log_rows(rows)
+
 # ─────────────────────── Cohere call ───────────────────────
-def call_cohere(prompt_data: str) -> dict:
+_FENCE_RE = re.compile(r"```(?:json)?")
+
+# The pipeline upstream is deterministic, so repeat payloads build
+# byte-identical prompt strings — reuse the parsed reply instead of
+# paying another Cohere round-trip. Digest keys keep entries small.
+# SLEEPWISE_LLM_CACHE=0 disables reuse (e.g. while tuning the preamble).
+import hashlib
+from cachetools import LRUCache
+LLM_CACHE_ENABLED = os.getenv("SLEEPWISE_LLM_CACHE", "1") != "0"
+_llm_cache: LRUCache = LRUCache(maxsize=512)
+
+async def call_cohere(prompt_data: str) -> dict:
     if not co:
         return {
             "tip": "LLM not configured. Please set COHERE_API_KEY.",
             "confidence": "n/a"
         }
-    
+
+    key = hashlib.md5(prompt_data.encode()).hexdigest() if LLM_CACHE_ENABLED else None
+    if key is not None:
+        cached = _llm_cache.get(key)
+        if cached is not None:
+            return cached
+
     preamble = """
     You are a creative lifestyle sleep coach. You must respond with only a JSON object with three keys: 'tip', 'rationale', and 'confidence'.
     The 'tip' should be a single, actionable piece of advice.
@@ -177,43 +537,88 @@ def call_cohere(prompt_data: str) -> dict:
     """
 
     try:
-        response = co.chat(
+        response = await co.chat(
             model='command-a-03-2025',   # ✅ now using command-r-plus
             preamble=preamble,
             message=prompt_data
         )
-        text = response.text.strip()
-
         # Clean markdown fences like ```json ... ```
-        text = text.replace("```json", "").replace("```", "").strip()
+        text = _FENCE_RE.sub("", response.text).strip()
 
         try:
-            data = json.loads(text)
-            return {
+            data = orjson.loads(text)
+            out = {
                 "tip": data.get("tip", text),
                 "rationale": data.get("rationale", ""),
                 "confidence": data.get("confidence", "medium")
             }
         except Exception:
-            return {"tip": text, "confidence": "medium"}
+            out = {"tip": text, "confidence": "medium"}
+        if key is not None:
+            _llm_cache[key] = out
+        return out
     except Exception as e:
+        # transient failures are never cached
         return {"tip": f"LLM call failed: {str(e)}", "confidence": "n/a"}
 
-# ───────────────────────── Predict ─────────────────────────
-@app.post("/predict", response_model=PredictResponse)
-def predict(req: PredictRequest):
-    user_id = get_user_id_from_token(req.token)
-    X = preprocess_one(req)
+# Per-worker cache of the deterministic pipeline (preprocess + XGBoost +
+# SHAP). Identical payloads — page refreshes, UI re-submits — become a
+# dict lookup. The LLM tip is intentionally never cached here.
+_predict_cache: LRUCache = LRUCache(maxsize=10_000)
+
+async def predict_core(req: LogPayload) -> Tuple[float, int, List[str]]:
+    key = (req.age, req.gender, req.sleep_duration, req.physical_activity,
+           req.stress_level, req.bmi_category, req.blood_pressure,
+           req.heart_rate, req.daily_steps)
+    cached = _predict_cache.get(key)
+    if cached is not None:
+        return cached
 
-    pred_quality = float(regressor.predict(X)[0])
+    X = preprocess_one(req)
+    pred_quality, pred_class_idx, sv_class = await infer_one(X)
     pred_quality = max(1.0, min(10.0, pred_quality))
+    top2 = extract_top2_shap(sv_class, FEATURE_NAMES)
 
-    pred_class_idx = int(classifier.predict(X)[0])
-    disorder = RISK_MAP[pred_class_idx]
+    result = (pred_quality, pred_class_idx, top2)
+    _predict_cache[key] = result
+    return result
 
-    sv = shap_explainer(X)
-    sv_class = sv.values[0][:, pred_class_idx]
-    top2 = extract_top2_shap(sv_class, list(X.columns))
+# Prompt skeletons built once at import; per call only the values are
+# substituted via format_map, instead of re-assembling the multi-line
+# f-string (and its intermediate fragments) on every request.
+_PREDICT_PROMPT = """
+        You are a creative lifestyle sleep coach.
+        Input (de-identified):
+        - Age Bracket: {age_bracket}
+        - Sleep Duration: {sleep_duration}h
+        - Predicted Quality: {pred_quality}/10
+        - Stress Level: {stress_level}/10
+        - Daily Steps: {daily_steps}
+        - BMI: {bmi_category}
+        - Disorder Risk: {disorder}
+        - Top Drivers: {top_drivers}
+        """
+
+def build_predict_prompt(req: LogPayload, pred_quality: float, disorder: str,
+                         top2: List[str]) -> str:
+    return _PREDICT_PROMPT.format_map({
+        "age_bracket": age_to_bracket(req.age),
+        "sleep_duration": req.sleep_duration,
+        "pred_quality": round(pred_quality, 1),
+        "stress_level": req.stress_level,
+        "daily_steps": req.daily_steps,
+        "bmi_category": req.bmi_category,
+        "disorder": disorder,
+        "top_drivers": ", ".join(top2),
+    })
+
+# ───────────────────────── Predict ─────────────────────────
+@app.post("/predict", response_model=PredictResponse)
+async def predict(req: PredictRequest):
+    user_id = await get_user_id_from_token(req.token)
+
+    pred_quality, pred_class_idx, top2 = await predict_core(req)
+    disorder = RISK_LABELS[pred_class_idx]
 
     override_msg = rule_engine(disorder, req.bmi_category)
 
@@ -221,32 +626,14 @@ def predict(req: PredictRequest):
         out = {"tip": override_msg, "confidence": "n/a", "rationale": ""}
         flag = True
     else:
-        llm_prompt = f"""
-        You are a creative lifestyle sleep coach.
-        Input (de-identified):
-        - Age Bracket: {age_to_bracket(req.age)}
-        - Sleep Duration: {req.sleep_duration}h
-        - Predicted Quality: {round(pred_quality,1)}/10
-        - Stress Level: {req.stress_level}/10
-        - Daily Steps: {req.daily_steps}
-        - BMI: {req.bmi_category}
-        - Disorder Risk: {disorder}
-        - Top Drivers: {", ".join(top2)}
-        """
-        out = call_cohere(llm_prompt)
+        llm_prompt = build_predict_prompt(req, pred_quality, disorder, top2)
+        out = await call_cohere(llm_prompt)
         flag = False
 
         if supabase and user_id:
-            try:
-                supabase.table("coach_logs").insert({
-                    "user_id": str(user_id),
-                    "prompt": llm_prompt,
-                    "response": json.dumps(out),
-                    "created_at": datetime.now(timezone.utc).isoformat()
-                }).execute()
-                print("✅ Coach log stored (predict)")
-            except Exception as e:
-                print(f"❌ Failed to log coach output (predict): {e}")
+            # fire-and-forget: don't spend a Supabase round-trip on the
+            # user-visible response
+            asyncio.create_task(store_coach_log(user_id, llm_prompt, out, "predict"))
 
     return PredictResponse(
         predicted_quality=round(pred_quality, 1),
@@ -257,9 +644,57 @@ def predict(req: PredictRequest):
         rule_override_flag=flag
     )
 
+# ──────────────────── Predict (streaming) ──────────────────
+@app.post("/predict/stream")
+async def predict_stream(req: PredictRequest):
+    """NDJSON variant of /predict: the numeric prediction is flushed as
+    soon as inference finishes; the coach tip follows in a second line
+    once the LLM answers, so the UI never waits on Cohere to render."""
+    user_id = await get_user_id_from_token(req.token)
+
+    pred_quality, pred_class_idx, top2 = await predict_core(req)
+    disorder = RISK_LABELS[pred_class_idx]
+    override_msg = rule_engine(disorder, req.bmi_category)
+
+    async def gen():
+        yield orjson.dumps({
+            "predicted_quality": round(pred_quality, 1),
+            "disorder_risk": disorder,
+            "top_drivers": top2,
+            "rule_override_flag": override_msg is not None
+        }) + b"\n"
+
+        if override_msg:
+            out = {"tip": override_msg, "rationale": "", "confidence": "n/a"}
+        else:
+            llm_prompt = build_predict_prompt(req, pred_quality, disorder, top2)
+            out = await call_cohere(llm_prompt)
+            if supabase and user_id:
+                asyncio.create_task(store_coach_log(user_id, llm_prompt, out, "predict/stream"))
+
+        yield orjson.dumps({
+            "coach_tip": out.get("tip", ""),
+            "rationale": out.get("rationale", ""),
+            "confidence": out.get("confidence", "medium")
+        }) + b"\n"
+
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
+
 # ──────────────────────── Coach only ───────────────────────
+_COACH_PROMPT = """
+    You are a creative lifestyle sleep coach.
+    Input (de-identified):
+    - Age: {age}, Gender: {gender}
+    - Sleep Duration: {sleep_duration}h
+    - Stress Level: {stress_level}/10
+    - Daily Steps: {daily_steps}
+    - BMI: {bmi_category}
+    - Disorder Risk: {disorder_risk}
+    - Top Drivers: {top_drivers}
+    """
+
 @app.post("/coach")
-def coach_endpoint(
+async def coach_endpoint(
     token: Optional[str] = None,
     age: int = Body(...),
     gender: str = Body(...),
@@ -270,33 +705,23 @@ def coach_endpoint(
     disorder_risk: str = Body(...),
     top_drivers: List[str] = Body(...)
 ):
-    user_id = get_user_id_from_token(token)
+    user_id = await get_user_id_from_token(token)
 
-    llm_prompt = f"""
-    You are a creative lifestyle sleep coach.
-    Input (de-identified):
-    - Age: {age}, Gender: {gender}
-    - Sleep Duration: {sleep_duration}h
-    - Stress Level: {stress_level}/10
-    - Daily Steps: {daily_steps}
-    - BMI: {bmi_category}
-    - Disorder Risk: {disorder_risk}
-    - Top Drivers: {", ".join(top_drivers)}
-    """
+    llm_prompt = _COACH_PROMPT.format_map({
+        "age": age,
+        "gender": gender,
+        "sleep_duration": sleep_duration,
+        "stress_level": stress_level,
+        "daily_steps": daily_steps,
+        "bmi_category": bmi_category,
+        "disorder_risk": disorder_risk,
+        "top_drivers": ", ".join(top_drivers),
+    })
+
+    out = await call_cohere(llm_prompt)
 
-    out = call_cohere(llm_prompt)
-    
     if supabase and user_id:
-        try:
-            supabase.table("coach_logs").insert({
-                "user_id": str(user_id),
-                "prompt": llm_prompt,
-                "response": json.dumps(out),
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }).execute()
-            print("✅ Coach log stored (coach)")
-        except Exception as e:
-            print(f"❌ Failed to log coach output (coach): {e}")
+        asyncio.create_task(store_coach_log(user_id, llm_prompt, out, "coach"))
 
     return {
         "tip": out.get("tip", ""),
@@ -310,52 +735,54 @@ class LogRequest(LogPayload):
     token: Optional[str] = None  # JWT included in body
 
 @app.post("/log")
-def log_daily(req: LogRequest):
-    user_id = get_user_id_from_token(req.token)
+async def log_daily(req: LogRequest):
+    user_id = await get_user_id_from_token(req.token)
     if not user_id:
         raise HTTPException(401, "Invalid token")
 
     if supabase:
-        try:
-            supabase.table("sleep_logs").insert({
-                "user_id": user_id,
-                "age": req.age,
-                "gender": req.gender,
-                "sleep_duration": req.sleep_duration,
-                "physical_activity": req.physical_activity,
-                "stress_level": req.stress_level,
-                "bmi_category": req.bmi_category,
-                "blood_pressure": req.blood_pressure,
-                "heart_rate": req.heart_rate,
-                "daily_steps": req.daily_steps,
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }).execute()
-        except Exception as e:
-            raise HTTPException(400, f"Failed to log: {e}")
+        # enqueue only — the background flusher batches the insert
+        await log_queue.put({
+            "user_id": user_id,
+            "age": req.age,
+            "gender": req.gender,
+            "sleep_duration": req.sleep_duration,
+            "physical_activity": req.physical_activity,
+            "stress_level": req.stress_level,
+            "bmi_category": req.bmi_category,
+            "blood_pressure": req.blood_pressure,
+            "heart_rate": req.heart_rate,
+            "daily_steps": req.daily_steps,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
 
     return {"status": "ok", "message": "Daily log stored successfully"}
 
 # ───────────────────── Dashboard APIs ──────────────────────
 @app.get("/dashboard/series")
-def dashboard_series(
+async def dashboard_series(
     token: str = Query(..., description="Supabase JWT"),
     days: int = Query(7, ge=1, le=30)
 ):
-    user_id = get_user_id_from_token(token)
+    user_id = await get_user_id_from_token(token)
     if not user_id:
         raise HTTPException(401, "Invalid token")
 
     items: List[Dict[str, Any]] = []
     if supabase:
         try:
+            # cap rows server-side: newest days*4 entries, re-ascended
+            # locally. For denser logging, a pre-aggregated daily SQL
+            # view would bound this at <=30 rows regardless of frequency.
             since = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
-            resp = supabase.table("sleep_logs") \
+            resp = await supabase.table("sleep_logs") \
                 .select("created_at, sleep_duration, predicted_quality, stress_level, daily_steps") \
                 .eq("user_id", user_id) \
                 .gte("created_at", since) \
-                .order("created_at", desc=False) \
+                .order("created_at", desc=True) \
+                .limit(days * 4) \
                 .execute()
-            items = resp.data or []
+            items = (resp.data or [])[::-1]
         except Exception as e:
             raise HTTPException(400, f"Fetch failed: {e}")
 
@@ -365,66 +792,124 @@ def dashboard_series(
             "averages": {"sleep": 0, "quality": 0, "stress": 0, "steps": 0}
         }
 
-    df = pd.DataFrame(items)
-    log_count = len(df)
-    
-    df['sleep_duration'] = pd.to_numeric(df['sleep_duration']).fillna(0)
-    df['predicted_quality'] = pd.to_numeric(df['predicted_quality']).fillna(0)
-    df['stress_level'] = pd.to_numeric(df['stress_level']).fillna(0)
-    df['daily_steps'] = pd.to_numeric(df['daily_steps']).fillna(0)
+    # Postgres already types these columns; pull each one straight into a
+    # NumPy buffer (None → 0) rather than round-tripping a DataFrame.
+    log_count = len(items)
+    means = {
+        name: float(np.fromiter(
+            ((i.get(name) or 0) for i in items), dtype=np.float64, count=log_count
+        ).mean())
+        for name in ("sleep_duration", "predicted_quality", "stress_level", "daily_steps")
+    }
 
     averages = {
-        "sleep": round(df['sleep_duration'].sum() / log_count, 1),
-        "quality": round(df['predicted_quality'].sum() / log_count, 1),
-        "stress": round(df['stress_level'].sum() / log_count),
-        "steps": round(df['daily_steps'].sum() / log_count)
+        "sleep": round(means["sleep_duration"], 1),
+        "quality": round(means["predicted_quality"], 1),
+        "stress": round(means["stress_level"]),
+        "steps": round(means["daily_steps"])
     }
 
-    logs_for_response = df.to_dict('records')
-
-    return {"logs": logs_for_response, "averages": averages}
+    # items are plain dicts from PostgREST — return them as-is
+    return {"logs": items, "averages": averages}
 
 
 @app.get("/dashboard/top-drivers")
-def dashboard_top_drivers(
+async def dashboard_top_drivers(
     token: str = Query(..., description="Supabase JWT"),
     days: int = Query(7, ge=1, le=30)
 ):
-    user_id = get_user_id_from_token(token)
+    user_id = await get_user_id_from_token(token)
     if not user_id:
         raise HTTPException(401, "Invalid token")
 
+    since = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+
+    # Fast path: let Postgres unnest and count the drivers instead of
+    # shipping every row here. Requires this function in Supabase:
+    #
+    #   create function coach_driver_counts(uid uuid, since timestamptz)
+    #   returns table(driver text, cnt int) as $$
+    #     select d.val, count(*) from sleep_logs l,
+    #            jsonb_array_elements_text(l.top_drivers) d(val)
+    #     where l.user_id = uid and l.created_at >= since
+    #     group by d.val
+    #   $$ language sql stable;
+    if supabase:
+        try:
+            counts_resp = await supabase.rpc(
+                "coach_driver_counts", {"uid": user_id, "since": since}
+            ).execute()
+            latest_resp = await supabase.table("sleep_logs") \
+                .select("top_drivers") \
+                .eq("user_id", user_id) \
+                .gte("created_at", since) \
+                .order("created_at", desc=True) \
+                .limit(1) \
+                .execute()
+            counts = {r["driver"]: r["cnt"] for r in (counts_resp.data or [])}
+            latest_top = (latest_resp.data or [{}])[0].get("top_drivers") or []
+            if isinstance(latest_top, str):
+                latest_top = orjson.loads(latest_top)
+            return {"latest_top_drivers": latest_top, "driver_counts": counts}
+        except Exception:
+            pass  # RPC not deployed — fall back to client-side aggregation
+
     items = []
     if supabase:
         try:
-            since = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
-            resp = supabase.table("sleep_logs") \
+            resp = await supabase.table("sleep_logs") \
                 .select("top_drivers,created_at") \
                 .eq("user_id", user_id) \
                 .gte("created_at", since) \
-                .order("created_at", desc=False) \
+                .order("created_at", desc=True) \
+                .limit(days * 4) \
                 .execute()
-            items = resp.data or []
+            items = (resp.data or [])[::-1]
         except Exception as e:
             raise HTTPException(400, f"Fetch failed: {e}")
 
-    latest_top = []
-    counts: Dict[str,int] = {}
-    for i in items:
-        td = i.get("top_drivers")
-        if isinstance(td, str):
+    def row_drivers(row: Dict[str, Any]) -> List[str]:
+        td = row.get("top_drivers")
+        if isinstance(td, str):  # legacy rows stored JSON text, not jsonb
             try:
-                td = json.loads(td)
+                td = orjson.loads(td)
             except Exception:
                 td = []
-        if not latest_top and td:
-            latest_top = td
-        for f in (td or []):
-            counts[f] = counts.get(f, 0) + 1
+        return td or []
+
+    parsed = [row_drivers(i) for i in items]
+    counts = dict(Counter(chain.from_iterable(parsed)))
+    latest_top = next((td for td in parsed if td), [])
 
     return {"latest_top_drivers": latest_top, "driver_counts": counts}
 
+# ──────────────────────── Entrypoint ───────────────────────
+# Multi-worker deployments should prefork with the models already loaded
+# so the read-only artifact pages are shared copy-on-write:
+#
+#   PRELOAD_ARTIFACTS=1 gunicorn -w 4 -k uvicorn.workers.UvicornWorker --preload main:app
+#
+# --preload imports this module once in the parent; loading here makes
+# the lifespan load_artifacts() a no-op in each forked worker.
+if os.getenv("PRELOAD_ARTIFACTS") == "1":
+    load_artifacts()
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))  # Render automatically sets PORT
-    uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
\ No newline at end of file
+    if os.getenv("DEV") == "1":
+        # auto-reload is single-worker and keeps the default loop
+        uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
+    else:
+        # uvloop + httptools lift the event-loop/parse ceiling well above
+        # stdlib asyncio + h11, which matters once requests are mostly
+        # awaiting Cohere/Supabase rather than burning CPU
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=port,
+            loop="uvloop",
+            http="httptools",
+            workers=int(os.getenv("WEB_CONCURRENCY", "2")),
+            reload=False,
+        )
\ No newline at end of file